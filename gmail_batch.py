@@ -0,0 +1,184 @@
+import http.client
+import json
+import re
+import uuid
+from urllib.parse import quote, urlencode
+
+from google.auth.transport.requests import Request
+
+# Only the parts of a message resource the scan actually reads
+METADATA_FIELDS = 'id,sizeEstimate,internalDate,payload/headers'
+
+# A JSON string literal. An unescaped quote always ends one, so these patterns never match inside a value
+_STRING = rb'"(?:[^"\\]|\\.)*"'
+_HEADERS_RE = re.compile(rb'"headers"\s*:\s*\[((?:[^\]"]|' + _STRING + rb')*)\]')
+_OBJECT_RE = re.compile(rb'\{((?:[^{}"]|' + _STRING + rb')*)\}')
+_NAME_RE = re.compile(rb'"name"\s*:\s*(' + _STRING + rb')')
+_VALUE_RE = re.compile(rb'"value"\s*:\s*(' + _STRING + rb')')
+_ID_RE = re.compile(rb'"id"\s*:\s*(' + _STRING + rb')')
+_SIZE_RE = re.compile(rb'"sizeEstimate"\s*:\s*"?(\d+)')
+_DATE_RE = re.compile(rb'"internalDate"\s*:\s*"?(\d+)')
+_CONTENT_ID_RE = re.compile(rb'(?i)content-id\s*:\s*<(?:response-)?(\d+)>')
+
+
+class GmailBatchClient:
+    """Minimal client for the /batch/gmail/v1 endpoint, used on the scan hot path.
+
+    Sub-requests are rendered from a prebuilt template, the multipart/mixed
+    response is parsed part by part as it streams off one keep-alive
+    connection, and only id, sizeEstimate, internalDate and header
+    name/value pairs are pulled out of each part, never a full dict.
+    """
+
+    def __init__(self, credentials, host='gmail.googleapis.com', port=None, secure=True, timeout=60):
+        self.credentials = credentials
+        self.host = host
+        self.port = port
+        self.secure = secure
+        self.timeout = timeout
+        self.conn = None
+
+    def _connect(self):
+        if self.secure:
+            self.conn = http.client.HTTPSConnection(self.host, self.port, timeout=self.timeout)
+        else:
+            self.conn = http.client.HTTPConnection(self.host, self.port, timeout=self.timeout)
+
+    def close(self):
+        if self.conn is not None:
+            self.conn.close()
+            self.conn = None
+
+    def _auth_headers(self):
+        if not self.credentials.valid:
+            self.credentials.refresh(Request())
+        headers = {}
+        self.credentials.apply(headers)
+        return headers
+
+    def iter_metadata(self, message_ids, metadata_headers=('From',)):
+        """Fetch up to 100 messages in format=metadata and yield one tuple per success.
+
+        Each tuple is (gmail_id, [(header_name, header_value), ...], size_estimate,
+        internal_date), with headers in the order Gmail returned them. Failed
+        sub-requests are skipped, except that sub-requests rejected with 401
+        are retried once with refreshed credentials, as BatchHttpRequest does;
+        a second 401 raises.
+        """
+        unauthorized = []
+        yield from self._execute(message_ids, metadata_headers, unauthorized)
+        if not unauthorized:
+            return
+
+        self.credentials.refresh(Request())
+        retry = [message_ids[n] for n in unauthorized]
+        unauthorized = []
+        yield from self._execute(retry, metadata_headers, unauthorized)
+        if unauthorized:
+            raise RuntimeError(f'Batch sub-requests still unauthorized after refresh: '
+                               f'{[retry[n] for n in unauthorized]}')
+
+    def _execute(self, message_ids, metadata_headers, unauthorized):
+        """Send one batch, yield parsed parts and append the index of each 401 part to unauthorized."""
+        query = urlencode([('format', 'metadata'), ('fields', METADATA_FIELDS)]
+                          + [('metadataHeaders', name) for name in metadata_headers])
+        boundary = f'batch_{uuid.uuid4().hex}'
+        template = (f'--{boundary}\r\n'
+                    'Content-Type: application/http\r\n'
+                    'Content-Transfer-Encoding: binary\r\n'
+                    'Content-ID: <{n}>\r\n\r\n'
+                    'GET /gmail/v1/users/me/messages/{msg_id}?' + query + ' HTTP/1.1\r\n\r\n')
+        body = ''.join(template.format(n=n, msg_id=quote(msg_id, safe=''))
+                       for n, msg_id in enumerate(message_ids))
+        body = (body + f'--{boundary}--\r\n').encode()
+
+        headers = self._auth_headers()
+        headers['Content-Type'] = f'multipart/mixed; boundary={boundary}'
+        response, response_boundary = self._post(body, headers)
+        try:
+            yield from self._iter_parts(response, response_boundary, unauthorized)
+        finally:
+            # Drain whatever is left so the connection can be reused
+            response.read()
+
+    def _post(self, body, headers):
+        # A keep-alive connection the server has since dropped fails on first use; retry once fresh
+        for attempt in range(2):
+            if self.conn is None:
+                self._connect()
+            try:
+                self.conn.request('POST', '/batch/gmail/v1', body=body, headers=headers)
+                response = self.conn.getresponse()
+                break
+            except (http.client.RemoteDisconnected, ConnectionError):
+                self.close()
+                if attempt:
+                    raise
+
+        if response.status != 200:
+            detail = response.read()
+            raise RuntimeError(f'Batch request failed: HTTP {response.status} {detail[:200]!r}')
+
+        match = re.search(r'boundary="?([^";]+)"?', response.getheader('Content-Type', ''))
+        if not match:
+            response.read()
+            raise RuntimeError('Batch response is not multipart')
+        return response, match.group(1).encode()
+
+    def _iter_parts(self, response, boundary, unauthorized):
+        delimiter = b'--' + boundary
+        line = response.readline()
+        while line and not line.startswith(delimiter):
+            line = response.readline()
+
+        while line and not line.rstrip().endswith(b'--'):
+            # Outer part headers (Content-Type: application/http, Content-ID: <response-N>)
+            content_id = None
+            line = response.readline()
+            while line.strip():
+                match = _CONTENT_ID_RE.match(line)
+                if match:
+                    content_id = int(match.group(1))
+                line = response.readline()
+
+            status_line = response.readline()
+            line = response.readline()
+            while line.strip():
+                line = response.readline()
+
+            chunks = []
+            line = response.readline()
+            while line and not line.startswith(delimiter):
+                chunks.append(line)
+                line = response.readline()
+
+            status = status_line.split(None, 2)
+            if len(status) > 1 and status[1].startswith(b'2'):
+                yield self._parse_part(b''.join(chunks))
+            elif len(status) > 1 and status[1] == b'401':
+                if content_id is None:
+                    raise RuntimeError('Unauthorized batch response part without a Content-ID')
+                unauthorized.append(content_id)
+
+    @staticmethod
+    def _parse_part(body):
+        headers = []
+        rest = body
+        headers_match = _HEADERS_RE.search(body)
+        if headers_match:
+            for entry in _OBJECT_RE.findall(headers_match.group(1)):
+                name = _NAME_RE.search(entry)
+                value = _VALUE_RE.search(entry)
+                if name and value:
+                    headers.append((json.loads(name.group(1)), json.loads(value.group(1))))
+            # The message id is the only "id" key left once the headers are cut out
+            rest = body[:headers_match.start()] + body[headers_match.end():]
+
+        msg_id = _ID_RE.search(rest)
+        if msg_id is None:
+            # Fail loudly rather than let a format change quietly zero the counts
+            raise ValueError(f'Unrecognised batch response part: {body[:200]!r}')
+        size = _SIZE_RE.search(rest)
+        date = _DATE_RE.search(rest)
+        return (json.loads(msg_id.group(1)), headers,
+                int(size.group(1)) if size else 0, int(date.group(1)) if date else 0)
@@ -1,7 +1,7 @@
 import tkinter as tk
 from tkinter import ttk, messagebox, scrolledtext
-from main import authenticate_and_build_service as authenticate
-from main import get_top_senders, delete_from_sender
+from main import authenticate_and_build_service as authenticate, load_credentials
+from main import get_top_senders, delete_from_sender, delete_duplicates, DuplicateIndex, SpaceSaving
 import threading
 
 
@@ -32,7 +32,9 @@ class ModernGmailCleanerGUI:
         }
         
         self.service = None
+        self.credentials = None
         self.senders = []
+        self.duplicates = None
         
         self.setup_ui()
 
@@ -128,6 +130,21 @@ class ModernGmailCleanerGUI:
         
         return spinbox_frame, spinbox
 
+    def create_modern_checkbox(self, parent, text, variable):
+        """Create a modern checkbox on the page background"""
+        return tk.Checkbutton(
+            parent,
+            text=text,
+            variable=variable,
+            bg=self.colors['bg_primary'],
+            fg=self.colors['text_secondary'],
+            font=('Segoe UI', 10),
+            selectcolor=self.colors['bg_tertiary'],
+            activebackground=self.colors['bg_primary'],
+            activeforeground=self.colors['text_primary'],
+            relief='flat'
+        )
+
     def create_modern_progress_bar(self, parent, width=600, height=8):
         """Create a modern progress bar"""
         progress_frame = tk.Frame(parent, bg=self.colors['bg_primary'], height=height + 20)
@@ -334,6 +351,17 @@ class ModernGmailCleanerGUI:
         )
         self.scan_button_frame.pack()
         
+        # Scan options
+        self.full_scan_var = tk.BooleanVar()
+        self.create_modern_checkbox(
+            scan_section, "Scan entire mailbox (approximate counts)", self.full_scan_var
+        ).pack(pady=(10, 0))
+        
+        self.dedupe_var = tk.BooleanVar()
+        self.create_modern_checkbox(
+            scan_section, "Find duplicate messages (uses more memory)", self.dedupe_var
+        ).pack()
+        
         # Scan Progress
         self.scan_progress_frame = self.create_modern_progress_bar(scan_section, width=600)
         self.scan_progress_frame.pack(pady=(20, 0))
@@ -395,6 +423,12 @@ class ModernGmailCleanerGUI:
         )
         self.delete_button_frame.pack()
         
+        self.dedupe_button_frame, self.dedupe_button = self.create_modern_button(
+            delete_section, "🧹 Delete Duplicates", self.start_dedupe_thread,
+            self.colors['accent_secondary'], self.colors['accent_secondary_hover'], width=250, height=50
+        )
+        self.dedupe_button_frame.pack(pady=(15, 0))
+        
         # Delete Progress
         self.delete_progress_frame = self.create_modern_progress_bar(delete_section, width=600)
         self.delete_progress_frame.pack(pady=(20, 0))
@@ -449,17 +483,24 @@ class ModernGmailCleanerGUI:
         self.log_text.configure(state="disabled")
         self.root.update_idletasks()
 
+    def set_busy(self, busy):
+        """Scan, delete and dedupe all touch self.duplicates, so only one may run at a time"""
+        state = 'disabled' if busy else 'normal'
+        for button in (self.scan_button, self.delete_button, self.dedupe_button):
+            button.config(state=state)
+
     def start_scan_thread(self):
-        self.scan_button.config(state='disabled')
+        self.set_busy(True)
         threading.Thread(target=self.scan_top_senders, daemon=True).start()
 
     def scan_top_senders(self):
         self.log("🔐 Authenticating...")
         try:
-            self.service = authenticate()
+            self.credentials = load_credentials()
+            self.service = authenticate(self.credentials)
         except Exception as e:
             self.log(f"❌ Authentication failed: {e}")
-            self.scan_button.config(state='normal')
+            self.set_busy(False)
             return
 
         self.log("✅ Authenticated. Fetching top senders...")
@@ -472,7 +513,18 @@ class ModernGmailCleanerGUI:
         except:
             top_n = 10
 
-        self.senders = get_top_senders(self.service, max_messages=1500, top_n=top_n, progress_callback=scan_callback)
+        self.duplicates = DuplicateIndex() if self.dedupe_var.get() else None
+        if self.full_scan_var.get():
+            # Unbounded scan: counts come from a fixed-size sketch with per-sender error bounds
+            sketch = SpaceSaving()
+            self.senders = get_top_senders(self.service, self.credentials, max_messages=None, top_n=top_n,
+                                           progress_callback=scan_callback, streaming=True,
+                                           workers=8, duplicate_index=self.duplicates, sketch=sketch)
+            self.log(f"📐 Scanned {sketch.total} emails; counts are over by at most {sketch.error_bound}.")
+        else:
+            self.senders = get_top_senders(self.service, self.credentials, max_messages=1500, top_n=top_n,
+                                           progress_callback=scan_callback,
+                                           duplicate_index=self.duplicates)
         self.check_vars = []
 
         # Clear previous checkboxes
@@ -482,8 +534,9 @@ class ModernGmailCleanerGUI:
         if not self.senders:
             self.log("⚠️ No senders found.")
         else:
-            for sender, count in self.senders:
+            for sender, count, error in self.senders:
                 var = tk.BooleanVar()
+                label = f"{sender} ({count} emails)" if not error else f"{sender} ({count - error}–{count} emails)"
                 
                 # Create modern checkbox
                 checkbox_frame = tk.Frame(self.senders_scrollable_frame, bg=self.colors['bg_secondary'])
@@ -491,7 +544,7 @@ class ModernGmailCleanerGUI:
                 
                 cb = tk.Checkbutton(
                     checkbox_frame,
-                    text=f"{sender} ({count} emails)",
+                    text=label,
                     variable=var,
                     bg=self.colors['bg_secondary'],
                     fg=self.colors['text_primary'],
@@ -507,28 +560,33 @@ class ModernGmailCleanerGUI:
 
             self.log("📋 Top senders loaded.")
 
+        if self.duplicates is not None:
+            groups = self.duplicates.duplicate_groups()
+            redundant = sum(len(copies) - 1 for copies in groups.values())
+            self.log(f"🧬 Found {redundant} duplicate copies of {len(groups)} messages.")
+
         self.scan_progress_frame.update_progress(0, 1)
-        self.scan_button.config(state='normal')
+        self.set_busy(False)
 
     def start_delete_thread(self):
-        self.delete_button.config(state='disabled')
+        self.set_busy(True)
         threading.Thread(target=self.delete_selected, daemon=True).start()
 
     def delete_selected(self):
         if not self.service:
             messagebox.showerror("Error", "Please scan top senders first.")
-            self.delete_button.config(state='normal')
+            self.set_busy(False)
             return
 
         to_delete = [sender for var, sender in self.check_vars if var.get()]
         if not to_delete:
             messagebox.showinfo("No Selection", "Please select at least one sender.")
-            self.delete_button.config(state='normal')
+            self.set_busy(False)
             return
 
         confirm = messagebox.askyesno("Confirm Deletion", f"Are you sure you want to delete emails from {len(to_delete)} senders?")
         if not confirm:
-            self.delete_button.config(state='normal')
+            self.set_busy(False)
             return
 
         keyword = self.keyword_entry.get().strip()
@@ -554,20 +612,54 @@ class ModernGmailCleanerGUI:
             def delete_callback(step, total, _sender=sender):
                 self.delete_progress_frame.update_progress(step, total)
 
-            delete_from_sender(
+            deleted = delete_from_sender(
                 self.service,
+                self.credentials,
                 sender,
                 log_func=self.log,
                 progress_callback=delete_callback,
                 keyword=keyword,
                 older_than_days=older_than,
-                after=after,
-                before=before,
+                after_date=after,
+                before_date=before,
             )
+            # Keep the duplicate index in step so it never targets a gone or last-remaining copy
+            if self.duplicates is not None:
+                self.duplicates.discard(deleted)
 
         self.log("✅ Deletion completed.")
         self.delete_progress_frame.update_progress(0, 1)
-        self.delete_button.config(state='normal')
+        self.set_busy(False)
+
+
+    def start_dedupe_thread(self):
+        self.set_busy(True)
+        threading.Thread(target=self.delete_duplicate_messages, daemon=True).start()
+
+    def delete_duplicate_messages(self):
+        if not self.service or self.duplicates is None:
+            messagebox.showerror("Error", "Please tick 'Find duplicate messages' and scan first.")
+            self.set_busy(False)
+            return
+
+        redundant = len(self.duplicates.redundant_ids())
+        if not redundant:
+            messagebox.showinfo("No Duplicates", "The last scan found no duplicate messages.")
+            self.set_busy(False)
+            return
+
+        confirm = messagebox.askyesno("Confirm Deletion", f"Delete {redundant} duplicate emails? The oldest copy of each is kept.")
+        if not confirm:
+            self.set_busy(False)
+            return
+
+        def delete_callback(step, total):
+            self.delete_progress_frame.update_progress(step, total)
+
+        delete_duplicates(self.service, self.duplicates, log_func=self.log, progress_callback=delete_callback)
+
+        self.delete_progress_frame.update_progress(0, 1)
+        self.set_busy(False)
 
 
 if __name__ == "__main__":
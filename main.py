@@ -1,16 +1,29 @@
 import os
 import re
-from collections import Counter
+import threading
+import time
+from collections import Counter, deque
+from concurrent.futures import FIRST_COMPLETED, ThreadPoolExecutor, wait
+from datetime import datetime, timezone
+
+import google_auth_httplib2
+import httplib2
 from google.auth.transport.requests import Request
 from google.oauth2.credentials import Credentials
 from google_auth_oauthlib.flow import InstalledAppFlow
 from googleapiclient.discovery import build
-from googleapiclient.http import BatchHttpRequest
+
+from gmail_batch import GmailBatchClient
 
 SCOPES = ['https://www.googleapis.com/auth/gmail.modify', 'https://mail.google.com/']
 
+# First interior boundary of the windowed listing; older (imported) mail lands in the open first window
+GMAIL_EPOCH = int(datetime(2004, 4, 1, tzinfo=timezone.utc).timestamp())
+# Windows narrower than this are paged sequentially instead of split further
+MIN_WINDOW_SECONDS = 3600
+
 
-def authenticate_and_build_service():
+def load_credentials():
     creds = None
     if os.path.exists('token.json'):
         creds = Credentials.from_authorized_user_file('token.json', SCOPES)
@@ -23,7 +36,12 @@ def authenticate_and_build_service():
             creds = flow.run_local_server(port=0)
         with open('token.json', 'w') as token:
             token.write(creds.to_json())
+    return creds
+
 
+def authenticate_and_build_service(creds=None):
+    if creds is None:
+        creds = load_credentials()
     service = build('gmail', 'v1', credentials=creds)
     return service
 
@@ -33,64 +51,471 @@ def extract_email(sender):
     return match.group(1) if match else sender.strip()
 
 
-def get_top_senders(service, max_messages=3000, top_n=10, progress_callback=None):
-    sender_counts = Counter()
+class SpaceSaving:
+    """Space-Saving heavy-hitters sketch (Metwally et al.) with a fixed number of counters.
+
+    Every stored count over-estimates the true count by at most its recorded
+    error, and that error never exceeds total / capacity. Any item seen more
+    than total / capacity times is guaranteed to be tracked.
+    """
+
+    def __init__(self, capacity=1000):
+        if capacity < 1:
+            raise ValueError("capacity must be at least 1")
+        self.capacity = capacity
+        self.total = 0
+        self.counts = {}      # item -> count
+        self.errors = {}      # item -> over-estimation bound
+        self.buckets = {}     # count -> set of items with that count
+        self.min_count = 0
+
+    def _move(self, item, old, new):
+        bucket = self.buckets[old]
+        bucket.discard(item)
+        if not bucket:
+            del self.buckets[old]
+        self.buckets.setdefault(new, set()).add(item)
+        self.counts[item] = new
+
+    def add(self, item):
+        self.total += 1
+        count = self.counts.get(item)
+        if count is not None:
+            self._move(item, count, count + 1)
+            if count == self.min_count and count not in self.buckets:
+                self.min_count = count + 1
+            return
+
+        if len(self.counts) < self.capacity:
+            self.counts[item] = 1
+            self.errors[item] = 0
+            self.buckets.setdefault(1, set()).add(item)
+            self.min_count = 1
+            return
+
+        # Evict one of the smallest counters and hand its count to the newcomer
+        floor = self.min_count
+        victim = next(iter(self.buckets[floor]))
+        self.buckets[floor].discard(victim)
+        del self.counts[victim]
+        del self.errors[victim]
+        if not self.buckets[floor]:
+            del self.buckets[floor]
+            self.min_count = floor + 1
+        self.counts[item] = floor + 1
+        self.errors[item] = floor
+        self.buckets.setdefault(floor + 1, set()).add(item)
+
+    @property
+    def error_bound(self):
+        """Maximum over-estimation of any reported count."""
+        return self.total // self.capacity
+
+    def most_common(self, n=None):
+        """Return [(item, count, error), ...] sorted by descending count."""
+        ranked = sorted(self.counts.items(), key=lambda kv: kv[1], reverse=True)
+        if n is not None:
+            ranked = ranked[:n]
+        return [(item, count, self.errors[item]) for item, count in ranked]
+
+
+class DuplicateIndex:
+    """Hash index of Message-ID -> copies, filled during the metadata scan.
+
+    Messages sharing a Message-ID header are copies of one another (list
+    cross-posts, repeated imports), so every duplicate group falls out of a
+    single pass over the scanned messages.
+    """
+
+    def __init__(self):
+        # Message-ID -> (internal_date, size, gmail_id); a list only once a second copy turns up
+        self.copies = {}
+        self._groups = None
+
+    def add(self, gmail_id, message_id, size, internal_date):
+        if not message_id:
+            return
+        key = message_id.strip()
+        copy = (internal_date, size, gmail_id)
+        existing = self.copies.get(key)
+        if existing is None:
+            self.copies[key] = copy
+        elif isinstance(existing, list):
+            # A message seen twice is not its own duplicate
+            if all(other[2] != gmail_id for other in existing):
+                existing.append(copy)
+        elif existing[2] != gmail_id:
+            self.copies[key] = [existing, copy]
+        self._groups = None
+
+    def discard(self, gmail_ids):
+        """Forget deleted messages so the oldest surviving copy is the one kept."""
+        gone = set(gmail_ids)
+        if not gone:
+            return
+        for key, copies in list(self.copies.items()):
+            if isinstance(copies, list):
+                left = [copy for copy in copies if copy[2] not in gone]
+                if len(left) > 1:
+                    self.copies[key] = left
+                elif left:
+                    self.copies[key] = left[0]
+                else:
+                    del self.copies[key]
+            elif copies[2] in gone:
+                del self.copies[key]
+        self._groups = None
+
+    def duplicate_groups(self):
+        """Return {Message-ID: [(internal_date, size, gmail_id), ...]} for every group with copies, oldest first."""
+        if self._groups is None:
+            self._groups = {message_id: sorted(copies) for message_id, copies in self.copies.items()
+                            if isinstance(copies, list)}
+        return self._groups
+
+    def redundant_ids(self):
+        """Gmail IDs of every copy except the oldest one in each group."""
+        return [gmail_id for copies in self.duplicate_groups().values()
+                for _, _, gmail_id in copies[1:]]
+
+
+def _fetch_senders(client, message_ids, on_sender, duplicate_index=None):
+    """Fetch the From header of up to 100 messages in a single batch request.
+
+    When duplicate_index is given, Message-ID, size and date come back in the
+    same sub-requests and are recorded in it.
+    """
+    metadata_headers = ['From', 'Message-ID'] if duplicate_index is not None else ['From']
+
+    for msg_id, headers, size, internal_date in client.iter_metadata(message_ids, metadata_headers):
+        sender = next((value for name, value in headers if name == 'From'), None)
+        if sender:
+            on_sender(sender)
+        if duplicate_index is not None:
+            # Senders spell it Message-ID, Message-Id, ...
+            message_id = next((value for name, value in headers if name.lower() == 'message-id'), None)
+            duplicate_index.add(msg_id, message_id, size, internal_date)
+
+
+_thread_state = threading.local()
+
+
+def _thread_http(credentials):
+    """Per-thread authorized Http; httplib2 connections must not be shared across threads."""
+    http = getattr(_thread_state, 'http', None)
+    if http is None or http.credentials is not credentials:
+        http = google_auth_httplib2.AuthorizedHttp(credentials, http=httplib2.Http())
+        _thread_state.http = http
+    return http
+
+
+def _window_query(query, after, before):
+    parts = [query] if query else []
+    if after is not None:
+        parts.append(f'after:{after}')
+    if before is not None:
+        parts.append(f'before:{before}')
+    return ' '.join(parts)
+
+
+def _list_pages(service, http, q, label_ids, response):
+    """Collect every ID for q, following the nextPageToken chain from response."""
+    ids = [msg['id'] for msg in response.get('messages', [])]
+    next_page_token = response.get('nextPageToken')
+    while next_page_token:
+        response = service.users().messages().list(
+            userId='me', q=q, labelIds=label_ids, maxResults=500, pageToken=next_page_token
+        ).execute(http=http)
+        ids.extend(msg['id'] for msg in response.get('messages', []))
+        next_page_token = response.get('nextPageToken')
+    return ids
+
+
+def _split_point(after, before, now):
+    """Where to halve a window, or None when it is too narrow to split. None bounds are open."""
+    if after is None:
+        if before is None or before - GMAIL_EPOCH > MIN_WINDOW_SECONDS:
+            return GMAIL_EPOCH
+        return None
+    if before is None:
+        return now if now - after > MIN_WINDOW_SECONDS else None
+    return (after + before) // 2 if before - after > MIN_WINDOW_SECONDS else None
+
+
+def _list_window(service, credentials, query, label_ids, after, before, now):
+    """List one window. Returns (ids, split); a dense window returns a split point instead of IDs."""
+    http = _thread_http(credentials)
+    q = _window_query(query, after, before)
+    response = service.users().messages().list(
+        userId='me', q=q, labelIds=label_ids, maxResults=500
+    ).execute(http=http)
+
+    if response.get('nextPageToken'):
+        split = _split_point(after, before, now)
+        if split is not None:
+            return [], split
+    return _list_pages(service, http, q, label_ids, response), None
+
+
+def _list_boundary(service, credentials, query, label_ids, second):
+    """IDs dated within a second of a window boundary, whichever side the API puts them on."""
+    http = _thread_http(credentials)
+    q = _window_query(query, second - 1, second + 1)
+    response = service.users().messages().list(
+        userId='me', q=q, labelIds=label_ids, maxResults=500
+    ).execute(http=http)
+    return set(_list_pages(service, http, q, label_ids, response))
+
+
+def iter_message_id_pages(service, credentials, query='', label_ids=None, workers=8, max_messages=None):
+    """Yield (ids, estimate) pages of message IDs matching query, listing date windows in parallel.
+
+    The query is first listed once without windows; if that fits in one page
+    it is the whole answer, so small queries cost a single call. Otherwise the
+    mailbox is cut into `workers` after:/before: slices which are listed
+    concurrently; the first slice has no after: and the last no before:, so
+    imported mail dated before Gmail existed or in the future is still found.
+    A slice whose first page has a nextPageToken is halved and re-queued, so no
+    single nextPageToken chain bounds the listing. That first page is thrown
+    away, so a dense slice costs one extra list call per level it is split.
+
+    Only messages dated on a shared boundary second can come back from two
+    neighbouring slices. Each boundary second is listed once on its own and
+    its IDs are left out of both neighbours. That is one extra list call per
+    boundary.
+
+    At most 2 * workers slices are listed ahead of the caller; the rest wait
+    in a queue, oldest first, so buffered IDs stay around workers * 1000 however
+    slowly pages are consumed.
+
+    estimate is Gmail's resultSizeEstimate for the whole query.
+    """
+    response = service.users().messages().list(
+        userId='me', q=query, labelIds=label_ids, maxResults=500
+    ).execute(http=_thread_http(credentials))
+    estimate = response.get('resultSizeEstimate', 0)
+    if not response.get('nextPageToken'):
+        page = [msg['id'] for msg in response.get('messages', [])]
+        if max_messages is not None:
+            page = page[:max_messages]
+        if page:
+            yield page, estimate
+        return
+
+    now = int(time.time()) + 86400
+    step = max((now - GMAIL_EPOCH) // workers, 1)
+    edges = [GMAIL_EPOCH + step * i for i in range(1, workers)]
+
+    fetched = 0
+    windows = {}       # future -> (after, before), listed but not yet yielded
+    queued = deque()   # (after, before) waiting for a free slot
+    boundaries = {}    # second -> [future of ID set or None, windows touching it, yielded]
+
+    with ThreadPoolExecutor(max_workers=workers) as pool:
+        def open_window(after, before):
+            queued.append((after, before))
+            for edge in (after, before):
+                if edge is not None:
+                    boundaries.setdefault(edge, [None, 0, False])[1] += 1
+
+        def fill():
+            while queued and len(windows) < 2 * workers:
+                after, before = queued.popleft()
+                future = pool.submit(_list_window, service, credentials, query, label_ids, after, before, now)
+                windows[future] = (after, before)
+                for edge in (after, before):
+                    if edge is not None and boundaries[edge][0] is None:
+                        boundaries[edge][0] = pool.submit(_list_boundary, service, credentials, query,
+                                                          label_ids, edge)
+
+        def release(after, before):
+            for edge in (after, before):
+                if edge is not None:
+                    boundaries[edge][1] -= 1
+                    if not boundaries[edge][1]:
+                        del boundaries[edge]
+
+        for after, before in zip([None] + edges, edges + [None]):
+            open_window(after, before)
+        fill()
+
+        try:
+            while windows:
+                done, _ = wait(windows, return_when=FIRST_COMPLETED)
+                for future in done:
+                    after, before = windows.pop(future)
+                    ids, split = future.result()
+
+                    if split is not None:
+                        open_window(after, split)
+                        open_window(split, before)
+                        release(after, before)
+                        fill()
+                        continue
+
+                    page = []
+                    excluded = set()
+                    for edge in (after, before):
+                        if edge is None:
+                            continue
+                        edge_ids = boundaries[edge][0].result()
+                        excluded |= edge_ids
+                        if not boundaries[edge][2]:
+                            boundaries[edge][2] = True
+                            page.extend(edge_ids)
+                    page.extend(msg_id for msg_id in ids if msg_id not in excluded)
+                    release(after, before)
+                    fill()
+
+                    if max_messages is not None:
+                        page = page[:max_messages - fetched]
+                    fetched += len(page)
+                    if page:
+                        yield page, estimate
+                    if max_messages is not None and fetched >= max_messages:
+                        return
+        finally:
+            for future in windows:
+                future.cancel()
+            for boundary in boundaries.values():
+                if boundary[0] is not None:
+                    boundary[0].cancel()
+
+
+def list_message_ids(service, credentials, query='', label_ids=None, workers=8, max_messages=None):
+    """Return all message IDs matching query, listed in parallel date windows."""
     message_ids = []
+    for page, _ in iter_message_id_pages(service, credentials, query, label_ids, workers, max_messages):
+        message_ids.extend(page)
+    return message_ids
 
-    # Step 1: Fetch message IDs from inbox
+
+def _iter_inbox_pages(service, max_messages):
+    """Yield (ids, estimate) inbox pages, following the nextPageToken chain."""
     next_page_token = None
     fetched = 0
-    while fetched < max_messages:
+    estimate = None
+    while max_messages is None or fetched < max_messages:
         response = service.users().messages().list(
             userId='me',
             labelIds=['INBOX'],
             maxResults=500,
             pageToken=next_page_token
         ).execute()
+        if estimate is None:
+            estimate = response.get('resultSizeEstimate', 0)
 
         messages = response.get('messages', [])
-        message_ids.extend([msg['id'] for msg in messages])
+        if max_messages is not None:
+            messages = messages[:max_messages - fetched]
         fetched += len(messages)
+        yield [msg['id'] for msg in messages], estimate
 
         next_page_token = response.get('nextPageToken')
         if not next_page_token or len(messages) == 0:
             break
 
+
+def get_top_senders(service, credentials, max_messages=3000, top_n=10, progress_callback=None,
+                    streaming=False, sketch_size=1000, workers=1, duplicate_index=None, sketch=None):
+    """Return the top senders in the inbox as [(sender, count, error), ...].
+
+    The true count lies in [count - error, count]; error is 0 unless streaming.
+
+    With streaming=True each page of IDs is processed as soon as it is listed
+    and senders are tracked in a SpaceSaving sketch of sketch_size counters, so
+    memory stays constant however large the mailbox is. max_messages=None
+    removes the cap, and counts may over-estimate by error. Pass your own SpaceSaving as
+    sketch to read its error_bound (the worst case over every sender) after
+    the scan.
+
+    workers > 1 lists the inbox in parallel date windows (see
+    iter_message_id_pages) instead of walking the newest-first page chain.
+
+    Pass a DuplicateIndex to have the same scan collect Message-IDs for
+    duplicate detection. The index keeps an entry per scanned message, so
+    memory becomes O(n) again, streaming or not.
+    """
+    if workers > 1:
+        pages = iter_message_id_pages(service, credentials, label_ids=['INBOX'], workers=workers,
+                                      max_messages=max_messages)
+    else:
+        pages = _iter_inbox_pages(service, max_messages)
+
+    client = GmailBatchClient(credentials)
+    try:
+        if streaming:
+            if sketch is None:
+                sketch = SpaceSaving(sketch_size)
+            return _get_top_senders_streaming(client, pages, max_messages, top_n,
+                                              progress_callback, sketch, duplicate_index)
+        return _get_top_senders_counted(client, pages, top_n, progress_callback, duplicate_index)
+    finally:
+        client.close()
+
+
+def _get_top_senders_counted(client, pages, top_n, progress_callback, duplicate_index):
+    sender_counts = Counter()
+
+    # Step 1: Fetch message IDs from inbox
+    message_ids = []
+    for page, _ in pages:
+        message_ids.extend(page)
+
     # Step 2: Batch fetch metadata (headers)
-    def callback(request_id, response, exception):
-        if exception is None:
-            headers = response['payload'].get('headers', [])
-            sender = next((h['value'] for h in headers if h['name'] == 'From'), None)
-            if sender:
-                sender_counts[sender] += 1
+    def count_sender(sender):
+        sender_counts[sender] += 1
 
     total_batches = (len(message_ids) // 100) + 1
     for i in range(0, len(message_ids), 100):
         if progress_callback:
             progress_callback(i // 100 + 1, total_batches)
+        _fetch_senders(client, message_ids[i:i + 100], count_sender, duplicate_index)
+
+    return [(sender, count, 0) for sender, count in sender_counts.most_common(top_n)]
 
-        batch = BatchHttpRequest(
-            callback=callback,
-            batch_uri='https://gmail.googleapis.com/batch/gmail/v1'  # ✅ Fixed endpoint
-        )
-        for msg_id in message_ids[i:i + 100]:
-            batch.add(service.users().messages().get(
-                userId='me',
-                id=msg_id,
-                format='metadata',
-                metadataHeaders=['From']
-            ))
-        batch.execute()
 
-    return sender_counts.most_common(top_n)
+def _get_top_senders_streaming(client, pages, max_messages, top_n, progress_callback, sketch,
+                               duplicate_index):
+    # Progress total is only an estimate until the last page is listed
+    batch_no = 0
+    for page, estimate in pages:
+        if max_messages is not None:
+            estimate = min(estimate, max_messages)
+        total_batches = (estimate // 100) + 1
+        for i in range(0, len(page), 100):
+            batch_no += 1
+            total_batches = max(total_batches, batch_no)
+            if progress_callback:
+                progress_callback(batch_no, total_batches)
+            _fetch_senders(client, page[i:i + 100], sketch.add, duplicate_index)
 
+    return sketch.most_common(top_n)
 
 
 from datetime import datetime
 import re
 
-def delete_from_sender(service, sender, log_func=print, progress_callback=None,
-                       keyword=None, older_than_days=None, after_date=None, before_date=None):
+def delete_messages(service, message_ids, log_func=print, progress_callback=None):
+    """Delete messages by Gmail ID and return the IDs that were deleted."""
+    deleted = []
+    total = len(message_ids)
+    for i, msg_id in enumerate(message_ids):
+        try:
+            service.users().messages().delete(userId='me', id=msg_id).execute()
+            deleted.append(msg_id)
+        except Exception as e:
+            log_func(f"❌ Failed to delete message {msg_id}: {e}")
+
+        if progress_callback:
+            progress_callback(i + 1, total)
+
+    return deleted
+
+
+def delete_from_sender(service, credentials, sender, log_func=print, progress_callback=None,
+                       keyword=None, older_than_days=None, after_date=None, before_date=None,
+                       workers=8):
     email_only = extract_email(sender)
     
     # Build Gmail search query
@@ -114,43 +539,54 @@ def delete_from_sender(service, sender, log_func=print, progress_callback=None,
     query = ' '.join(query_parts)
     log_func(f"🔎 Using query: {query}")
 
-    response = service.users().messages().list(userId='me', q=query).execute()
-    messages = response.get('messages', [])
+    message_ids = list_message_ids(service, credentials, query=query, workers=workers)
 
-    if not messages:
+    if not message_ids:
         log_func(f"No messages found for query from {email_only}")
-        return
+        return []
 
-    count = 0
-    total = len(messages)
-    for i, msg in enumerate(messages):
-        try:
-            service.users().messages().delete(userId='me', id=msg['id']).execute()
-            count += 1
-        except Exception as e:
-            log_func(f"❌ Failed to delete message {msg['id']}: {e}")
+    deleted = delete_messages(service, message_ids, log_func, progress_callback)
+    log_func(f"✅ Deleted {len(deleted)} messages from {email_only}")
+    return deleted
 
-        if progress_callback:
-            progress_callback(i + 1, total)
 
-    log_func(f"✅ Deleted {count} messages from {email_only}")
+def delete_duplicates(service, duplicate_index, log_func=print, progress_callback=None):
+    """Delete every duplicate found by a scan, keeping the oldest copy of each message."""
+    message_ids = duplicate_index.redundant_ids()
+    if not message_ids:
+        log_func("No duplicate messages found")
+        return []
+
+    deleted = delete_messages(service, message_ids, log_func, progress_callback)
+    duplicate_index.discard(deleted)
+    log_func(f"✅ Deleted {len(deleted)} duplicate messages")
+    return deleted
 
 
 # CLI entry point (optional)
 if __name__ == '__main__':
-    service = authenticate_and_build_service()
+    creds = load_credentials()
+    service = authenticate_and_build_service(creds)
 
     print("🔍 Scanning inbox for top senders (this is fast now)...")
-    top_senders = get_top_senders(service)
+    duplicates = DuplicateIndex()
+    top_senders = get_top_senders(service, creds, duplicate_index=duplicates)
 
     print("\n📧 Top 10 Senders:")
-    for i, (sender, count) in enumerate(top_senders, 1):
+    for i, (sender, count, _) in enumerate(top_senders, 1):
         print(f"{i}. {sender} — {count} messages")
 
     print("\nChoose which senders to delete manually.")
-    for sender, count in top_senders:
+    for sender, count, _ in top_senders:
         choice = input(f"Delete {count} messages from '{sender}'? (y/n): ").strip().lower()
         if choice == 'y':
-            delete_from_sender(service, sender)
+            duplicates.discard(delete_from_sender(service, creds, sender))
         else:
             print(f"❌ Skipped {sender}")
+
+    groups = duplicates.duplicate_groups()
+    redundant = duplicates.redundant_ids()
+    if redundant:
+        choice = input(f"\nDelete {len(redundant)} duplicate copies of {len(groups)} messages? (y/n): ").strip().lower()
+        if choice == 'y':
+            delete_duplicates(service, duplicates)
@@ -0,0 +1,200 @@
+import json
+import re
+import threading
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from urllib.parse import parse_qs, urlparse
+
+import httplib2
+import pytest
+from googleapiclient.discovery import build
+from googleapiclient.http import BatchHttpRequest
+
+from gmail_batch import GmailBatchClient
+from main import DuplicateIndex, _fetch_senders
+
+
+def _message(i):
+    return {
+        'id': f'msg{i:04d}',
+        'internalDate': str(1600000000000 + i),
+        'sizeEstimate': 2000 + i,
+        'payload': {'headers': [
+            {'name': 'From', 'value': f'Ünïcode "Quoted {i % 5}" \\ [list] {{x}} <user{i % 5}@example.com>'},
+            {'name': 'Message-Id' if i % 2 else 'Message-ID', 'value': f'<{i % 11}@example.com>'},
+            {'name': 'X-Note', 'value': '"id": "not-the-id", "name": "From"'},
+        ]},
+    }
+
+
+MESSAGES = {m['id']: m for m in map(_message, range(230))}
+MESSAGES['msg0007']['payload']['headers'] = []
+del MESSAGES['msg0008']['payload']['headers']
+
+
+def _serialize(message, n):
+    """Vary the JSON layout the way a server legitimately might."""
+    if n % 3 == 0:
+        return json.dumps(message, indent=2)
+    if n % 3 == 1:
+        return json.dumps(message, separators=(',', ':'), ensure_ascii=False)
+    # Reordered keys: id last, value before name
+    payload = {'headers': [{'value': h['value'], 'name': h['name']}
+                           for h in message['payload'].get('headers', [])]}
+    reordered = {'sizeEstimate': message['sizeEstimate'], 'payload': payload,
+                 'internalDate': message['internalDate'], 'id': message['id']}
+    return json.dumps(reordered)
+
+
+class FakeGmailBatch(BaseHTTPRequestHandler):
+    protocol_version = 'HTTP/1.1'
+    connections = set()
+    unauthorized = {}  # msg_id -> how many more times to answer 401
+
+    def log_message(self, *args):
+        pass
+
+    def do_POST(self):
+        FakeGmailBatch.connections.add(self.client_address)
+        body = self.rfile.read(int(self.headers['Content-Length'])).decode()
+        parts = []
+        requests = re.findall(r'Content-ID:\s*<([^>]+)>.*?GET (\S+) HTTP/1.1', body, re.S | re.I)
+        for n, (content_id, path) in enumerate(requests):
+            url = urlparse(path)
+            query = parse_qs(url.query)
+            msg_id = url.path.rsplit('/', 1)[1]
+            if FakeGmailBatch.unauthorized.get(msg_id):
+                FakeGmailBatch.unauthorized[msg_id] -= 1
+                status, payload = '401 Unauthorized', json.dumps({'error': {'code': 401, 'message': 'Expired'}})
+            elif msg_id not in MESSAGES:
+                status, payload = '404 Not Found', json.dumps({'error': {'code': 404, 'message': 'Not Found'}})
+            else:
+                message = json.loads(json.dumps(MESSAGES[msg_id]))
+                wanted = {name.lower() for name in query['metadataHeaders']}
+                if 'headers' in message['payload']:
+                    message['payload']['headers'] = [h for h in message['payload']['headers']
+                                                     if h['name'].lower() in wanted]
+                status, payload = '200 OK', _serialize(message, n)
+            parts.append(f'--resp_B\r\nContent-Type: application/http\r\nContent-ID: <response-{content_id}>\r\n\r\n'
+                         f'HTTP/1.1 {status}\r\nContent-Type: application/json; charset=UTF-8\r\n\r\n'
+                         f'{payload}\r\n')
+        out = (''.join(parts) + '--resp_B--\r\n').encode()
+
+        # Chunked in small pieces so parts straddle reads
+        self.send_response(200)
+        self.send_header('Content-Type', 'multipart/mixed; boundary=resp_B')
+        self.send_header('Transfer-Encoding', 'chunked')
+        self.end_headers()
+        for i in range(0, len(out), 97):
+            chunk = out[i:i + 97]
+            self.wfile.write(b'%x\r\n%s\r\n' % (len(chunk), chunk))
+        self.wfile.write(b'0\r\n\r\n')
+
+
+class FakeCredentials:
+    valid = True
+
+    def __init__(self):
+        self.refreshes = 0
+
+    def apply(self, headers):
+        headers['Authorization'] = 'Bearer t'
+
+    def refresh(self, request):
+        self.refreshes += 1
+
+
+@pytest.fixture
+def server():
+    FakeGmailBatch.connections = set()
+    FakeGmailBatch.unauthorized = {}
+    fake_server = ThreadingHTTPServer(('127.0.0.1', 0), FakeGmailBatch)
+    threading.Thread(target=fake_server.serve_forever, daemon=True).start()
+    yield fake_server
+    fake_server.shutdown()
+    fake_server.server_close()
+
+
+@pytest.fixture
+def client(server):
+    batch_client = GmailBatchClient(FakeCredentials(), host='127.0.0.1', port=server.server_port, secure=False)
+    yield batch_client
+    batch_client.close()
+
+
+def _googleapiclient_results(server, msg_ids, metadata_headers):
+    """Run the previous hot path, BatchHttpRequest plus a dict callback, against the fake server."""
+    service = build('gmail', 'v1', http=httplib2.Http(), static_discovery=True)
+    results = []
+
+    def callback(request_id, response, exception):
+        if exception is None:
+            headers = response['payload'].get('headers', [])
+            results.append((response['id'], [(h['name'], h['value']) for h in headers],
+                            response.get('sizeEstimate', 0), int(response.get('internalDate', 0))))
+
+    for i in range(0, len(msg_ids), 100):
+        batch = BatchHttpRequest(callback=callback,
+                                 batch_uri=f'http://127.0.0.1:{server.server_port}/batch/gmail/v1')
+        for msg_id in msg_ids[i:i + 100]:
+            batch.add(service.users().messages().get(
+                userId='me', id=msg_id, format='metadata', metadataHeaders=metadata_headers
+            ))
+        batch.execute()
+    return results
+
+
+@pytest.mark.parametrize('metadata_headers', [['From'], ['From', 'Message-ID', 'X-Note']])
+def test_matches_batch_http_request_over_one_connection(server, client, metadata_headers):
+    msg_ids = list(MESSAGES) + ['missing']
+    expected = _googleapiclient_results(server, msg_ids, metadata_headers)
+    assert len(expected) == len(MESSAGES)
+    FakeGmailBatch.connections = set()
+
+    got = []
+    for i in range(0, len(msg_ids), 100):
+        got.extend(client.iter_metadata(msg_ids[i:i + 100], metadata_headers))
+
+    assert got == expected
+    assert len(FakeGmailBatch.connections) == 1
+
+
+def test_scan_counts_match_the_previous_callback(server, client):
+    msg_ids = list(MESSAGES)
+    expected_senders = []
+    expected_index = DuplicateIndex()
+    for msg_id, headers, size, internal_date in _googleapiclient_results(server, msg_ids, ['From', 'Message-ID']):
+        sender = next((value for name, value in headers if name == 'From'), None)
+        if sender:
+            expected_senders.append(sender)
+        message_id = next((value for name, value in headers if name.lower() == 'message-id'), None)
+        expected_index.add(msg_id, message_id, size, internal_date)
+
+    senders = []
+    index = DuplicateIndex()
+    for i in range(0, len(msg_ids), 100):
+        _fetch_senders(client, msg_ids[i:i + 100], senders.append, index)
+
+    assert senders == expected_senders
+    assert index.copies == expected_index.copies
+
+
+def test_unrecognised_part_raises():
+    with pytest.raises(ValueError):
+        GmailBatchClient._parse_part(b'{"message": {"identifier": "x"}}')
+
+
+def test_unauthorized_parts_are_retried_once_after_refresh(server, client):
+    msg_ids = list(MESSAGES)[:100]
+    expected = _googleapiclient_results(server, msg_ids, ['From'])
+
+    FakeGmailBatch.unauthorized = {'msg0003': 1, 'msg0042': 1}
+    got = list(client.iter_metadata(msg_ids, ['From']))
+
+    assert client.credentials.refreshes == 1
+    assert sorted(got) == sorted(expected)
+
+
+def test_parts_unauthorized_after_refresh_raise(client):
+    FakeGmailBatch.unauthorized = {'msg0003': 2}
+    with pytest.raises(RuntimeError):
+        list(client.iter_metadata(list(MESSAGES)[:10], ['From']))
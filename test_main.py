@@ -0,0 +1,165 @@
+import random
+import re
+import threading
+import time
+from collections import Counter
+
+import pytest
+
+import main
+from main import SpaceSaving
+
+
+def test_space_saving_bounds_hold_against_exact_counts():
+    rng = random.Random(7)
+    stream = [int(rng.paretovariate(1.1)) for _ in range(50000)]
+    sketch = SpaceSaving(capacity=40)
+    exact = Counter()
+
+    for item in stream:
+        sketch.add(item)
+        exact[item] += 1
+        assert sketch.min_count == min(sketch.counts.values())
+
+    assert sketch.total == len(stream)
+    assert len(sketch.counts) == 40
+    for item, count, error in sketch.most_common():
+        assert count - error <= exact[item] <= count
+        assert error <= sketch.error_bound
+
+    # Anything seen more than total / capacity times must be tracked
+    for item, true_count in exact.items():
+        if true_count > sketch.error_bound:
+            assert item in sketch.counts
+
+
+def test_space_saving_is_exact_below_capacity():
+    sketch = SpaceSaving(capacity=10)
+    for item in 'abracadabra':
+        sketch.add(item)
+    assert sketch.counts == dict(Counter('abracadabra'))
+    assert sketch.most_common(1) == [('a', 5, 0)]
+    assert all(error == 0 for _, _, error in sketch.most_common())
+    assert sketch.error_bound == 1
+
+
+def test_space_saving_rejects_empty_capacity():
+    with pytest.raises(ValueError):
+        SpaceSaving(capacity=0)
+
+
+
+class FakeMessages:
+    """messages.list over (id, epoch second) pairs; after:/before: are inclusive to provoke overlaps."""
+
+    def __init__(self, mailbox):
+        self.mailbox = mailbox
+        self.calls = 0
+        self.lock = threading.Lock()
+
+    def users(self):
+        return self
+
+    def messages(self):
+        return self
+
+    def list(self, userId, q='', labelIds=None, maxResults=500, pageToken=None):
+        return FakeListRequest(self, q, maxResults, pageToken)
+
+
+class FakeListRequest:
+    def __init__(self, fake, q, max_results, page_token):
+        self.fake, self.q, self.max_results, self.page_token = fake, q, max_results, page_token
+
+    def execute(self, http=None):
+        after = re.search(r'after:(\d+)', self.q)
+        before = re.search(r'before:(\d+)', self.q)
+        lo = int(after.group(1)) if after else float('-inf')
+        hi = int(before.group(1)) if before else float('inf')
+        hits = sorted(msg_id for msg_id, second in self.fake.mailbox if lo <= second <= hi)
+        start = int(self.page_token or 0)
+        response = {'messages': [{'id': msg_id} for msg_id in hits[start:start + self.max_results]],
+                    'resultSizeEstimate': len(hits)}
+        if start + self.max_results < len(hits):
+            response['nextPageToken'] = str(start + self.max_results)
+        with self.fake.lock:
+            self.fake.calls += 1
+        return response
+
+
+@pytest.fixture
+def mailbox(monkeypatch):
+    frozen = 1_700_000_000
+    monkeypatch.setattr(main.time, 'time', lambda: frozen)
+    now = frozen + 86400
+    rng = random.Random(3)
+    messages = [(f'r{i}', rng.randint(main.GMAIL_EPOCH, frozen)) for i in range(20000)]
+    messages += [(f'dense{i}', frozen - 5000) for i in range(1200)]       # one second, must be paged
+    messages += [(f'burst{i}', frozen - 90000 + i) for i in range(1500)]  # forces nested splits
+    messages += [(f'old{i}', 500_000_000 + i) for i in range(600)]        # imported, pre-Gmail
+    messages += [(f'future{i}', now + 10 * 86400 + i) for i in range(40)]
+    # Exactly on, and either side of, every initial window edge
+    for workers in (2, 3, 8):
+        step = (now - main.GMAIL_EPOCH) // workers
+        for i in range(workers + 1):
+            for offset in (-1, 0, 1):
+                messages.append((f'edge{workers}_{i}_{offset}', main.GMAIL_EPOCH + step * i + offset))
+    return messages
+
+
+@pytest.mark.parametrize('workers', [1, 2, 3, 8])
+def test_windowed_listing_returns_every_id_once(mailbox, workers):
+    ids = main.list_message_ids(FakeMessages(mailbox), object(), workers=workers)
+    assert len(ids) == len(set(ids))
+    assert set(ids) == {msg_id for msg_id, _ in mailbox}
+
+
+def test_windowed_listing_truncates_at_max_messages(mailbox):
+    ids = main.list_message_ids(FakeMessages(mailbox), object(), workers=4, max_messages=777)
+    assert len(ids) == len(set(ids)) == 777
+
+
+def test_windowed_listing_buffers_a_bounded_number_of_ids(mailbox, monkeypatch):
+    listed = [0]
+    lock = threading.Lock()
+    list_window = main._list_window
+
+    def counting_list_window(*args):
+        ids, split = list_window(*args)
+        with lock:
+            listed[0] += len(ids)
+        return ids, split
+
+    monkeypatch.setattr(main, '_list_window', counting_list_window)
+    workers = 2
+    seen = []
+    peak = 0
+    for page, _ in main.iter_message_id_pages(FakeMessages(mailbox), object(), workers=workers):
+        time.sleep(0.005)
+        seen.extend(page)
+        peak = max(peak, listed[0] - len(seen))
+
+    assert len(seen) == len(set(seen)) == len(mailbox)
+    # Only 2 * workers windows may be listed ahead; the dense one-second window pages past 500
+    assert peak <= 2 * workers * 500 + 1200
+
+
+def test_small_query_is_listed_with_a_single_call():
+    fake = FakeMessages([('a', 1_600_000_000), ('b', 1_600_000_500)])
+    assert sorted(main.list_message_ids(fake, object(), workers=8)) == ['a', 'b']
+    assert fake.calls == 1
+
+
+def test_duplicate_index_keeps_oldest_and_ignores_repeated_ids():
+    index = main.DuplicateIndex()
+    index.add('g1', '<a>', 10, 300)
+    index.add('g1', '<a>', 10, 300)
+    assert index.redundant_ids() == []
+
+    index.add('g2', '<a>', 10, 100)
+    index.add('g2', '<a>', 10, 100)
+    index.add('g3', '<a>', 10, 200)
+    assert index.redundant_ids() == ['g3', 'g1']
+
+    index.discard(['g2'])
+    assert index.redundant_ids() == ['g1']